@@ -0,0 +1,44 @@
+"""
+Cost of dose summation for realistic RTDOSE grid sizes, run from the repository root:
+    python benchmarks/bench_dose_sum.py
+"""
+from __future__ import print_function
+from os.path import join, dirname, abspath
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'dvh-check'))
+from dose_sum import DoseGrid, sum_dose_grids  # noqa: E402
+
+# (columns, rows, frames, spacing in mm)
+GRID_SIZES = [(100, 100, 60, 3.0), (200, 200, 120, 2.5), (256, 256, 200, 2.0)]
+BEAM_COUNT = 7
+
+
+def get_grid(columns, rows, frames, spacing, origin=(0., 0., 0.)):
+    values = np.random.random_sample((frames, rows, columns)).astype(np.float32)
+    x, y, z = [origin[i] + spacing * np.arange(n) for i, n in enumerate([columns, rows, frames])]
+    return DoseGrid(values, x, y, z)
+
+
+def benchmark(label, grids):
+    start = time.time()
+    summed = sum_dose_grids(grids)
+    elapsed = time.time() - start
+    print("%-45s %-16s %8.3f s  %7.1f Mvoxel/s" % (label, 'x'.join(str(n) for n in summed.shape[::-1]), elapsed,
+                                                 sum(grid.values.size for grid in grids) / elapsed / 1e6))
+
+
+def main():
+    for columns, rows, frames, spacing in GRID_SIZES:
+        beams = [get_grid(columns, rows, frames, spacing) for _ in range(BEAM_COUNT)]
+        benchmark("%s beams, same grid (no resampling)" % BEAM_COUNT, beams)
+
+        primary = get_grid(columns, rows, frames, spacing)
+        boost = get_grid(columns // 2, rows // 2, frames // 2, spacing * 0.8, origin=(31.3, 27.1, 12.7))
+        benchmark("primary + boost, trilinear resampling", [primary, boost])
+
+
+if __name__ == '__main__':
+    main()
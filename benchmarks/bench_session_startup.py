@@ -0,0 +1,61 @@
+"""
+Time to first render of a score card session, run from the repository root:
+    python benchmarks/bench_session_startup.py --sessions 20
+    python benchmarks/bench_session_startup.py --app-dir path/to/older/dvh-check  # e.g. a git worktree, to compare
+
+Each step is timed as the Bokeh server runs it. Server start runs server_lifecycle.on_server_loaded, if the app has
+one. The first session includes the imports of view.py. Every later session constructs a ScoreCardView and
+serializes its Document, as it is sent to the browser.
+"""
+from __future__ import print_function
+from os.path import join, dirname, abspath, isfile
+import argparse
+import sys
+import time
+
+
+def time_call(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time to first render of DVH-Check score card sessions')
+    parser.add_argument('--app-dir', default=join(dirname(dirname(abspath(__file__))), 'dvh-check'))
+    parser.add_argument('--sessions', type=int, default=20)
+    args = parser.parse_args()
+    sys.path.insert(0, abspath(args.app_dir))
+
+    from bokeh.document import Document
+    from bokeh.io import curdoc
+
+    def server_start():
+        if isfile(join(args.app_dir, 'server_lifecycle.py')):
+            import server_lifecycle
+            server_lifecycle.on_server_loaded(None)
+
+    def open_session():
+        import view
+        doc = Document()
+        curdoc().clear()  # ScoreCardView uses curdoc() in every version, as main.py does
+        score_card = view.ScoreCardView()
+        doc.add_root(score_card.layout)
+        doc.to_json()
+        return score_card
+
+    server_time = time_call(server_start)[0]
+    first_time = time_call(open_session)[0]
+    session_times = sorted(time_call(open_session)[0] for _ in range(args.sessions))
+
+    print("app:                    %s" % abspath(args.app_dir))
+    print("server start:           %8.1f ms" % (server_time * 1e3))
+    print("first session:          %8.1f ms  (includes importing view.py)" % (first_time * 1e3))
+    print("later sessions, median: %8.1f ms  (n=%s)" % (session_times[len(session_times) // 2] * 1e3,
+                                                        len(session_times)))
+    print("heavy modules loaded:   %s" % ', '.join(sorted(name for name in ['dicompylercore', 'pydicom', 'numpy']
+                                                          if name in sys.modules)))
+
+
+if __name__ == '__main__':
+    main()
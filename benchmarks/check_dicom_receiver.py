@@ -0,0 +1,147 @@
+"""
+Loopback check of the DICOM storage SCP, run from the repository root (requires pynetdicom):
+    python benchmarks/check_dicom_receiver.py --source path/to/rtplan_rtss_rtdose --associations 8
+
+A DicomReceiver is started on a temporary inbox, then several SCUs send a copy of the source plan file set each,
+concurrently and with new UIDs, to check files are written and plans are registered as they arrive.
+Objects with an invalid UID or a PatientID that is a path are sent too and must not leave the inbox.
+A file set copied into the inbox afterwards must be found by DicomReceiver.rescan without losing received plans.
+Exits with a non-zero status on failure.
+"""
+from __future__ import print_function
+from os import listdir, makedirs, walk
+from os.path import join, dirname, abspath, isfile
+from copy import deepcopy
+from threading import Thread
+import argparse
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'dvh-check'))
+from pydicom import read_file  # noqa: E402
+from pydicom.uid import generate_uid  # noqa: E402
+from dicom_receiver import DicomReceiver, SUCCESS  # noqa: E402
+from utilities import PARTIAL_FILE_SUFFIX  # noqa: E402
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def read_file_set(source_dir):
+    file_set = {}
+    for file_name in listdir(source_dir):
+        ds = read_file(join(source_dir, file_name), force=True)
+        modality = str(getattr(ds, 'Modality', '')).lower()
+        if modality in {'rtplan', 'rtstruct', 'rtdose'}:
+            file_set[modality] = ds
+    return file_set
+
+
+def copy_file_set(file_set, patient_id):
+    """Copy of file_set with new SOPInstanceUIDs and references, as a different plan of patient_id"""
+    file_set = {modality: deepcopy(ds) for modality, ds in file_set.items()}
+    uids = {modality: generate_uid() for modality in file_set}
+    for modality, ds in file_set.items():
+        ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID = uids[modality]
+        ds.PatientID = patient_id
+    file_set['rtplan'].ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID = uids['rtstruct']
+    file_set['rtdose'].ReferencedRTPlanSequence[0].ReferencedSOPInstanceUID = uids['rtplan']
+    file_set['rtplan'].RTPlanLabel = patient_id
+    return file_set
+
+
+def send(port, datasets, statuses):
+    from pynetdicom import AE
+    from pynetdicom.sop_class import RTPlanStorage, RTStructureSetStorage, RTDoseStorage
+    ae = AE(ae_title='CHECK_SCU')
+    for sop_class in [RTPlanStorage, RTStructureSetStorage, RTDoseStorage]:
+        ae.add_requested_context(sop_class)
+    assoc = ae.associate('127.0.0.1', port)
+    if not assoc.is_established:
+        statuses.append(None)
+        return
+    for ds in datasets:
+        status = assoc.send_c_store(ds)
+        statuses.append(status.Status if status else None)
+    assoc.release()
+
+
+def check(condition, message, failures):
+    print("%-4s %s" % (['FAIL', 'ok'][bool(condition)], message))
+    if not condition:
+        failures.append(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loopback check of the DVH-Check DICOM receiver')
+    parser.add_argument('--source', required=True, help='directory with an RTPLAN, RTSTRUCT and RTDOSE')
+    parser.add_argument('--associations', type=int, default=8, help='concurrent SCUs, each sends one file set')
+    args = parser.parse_args()
+
+    source = read_file_set(args.source)
+    if set(source) != {'rtplan', 'rtstruct', 'rtdose'}:
+        sys.exit("%s must contain an RTPLAN, RTSTRUCT and RTDOSE" % args.source)
+
+    root = tempfile.mkdtemp()
+    inbox_dir = join(root, 'inbox')
+    makedirs(inbox_dir)
+    port = get_free_port()
+    receiver = DicomReceiver(inbox_dir=inbox_dir, port=port, max_associations=args.associations + 2)
+    receiver.start()
+    failures = []
+    try:
+        # valid file sets, sent concurrently
+        file_sets = [copy_file_set(source, 'PATIENT_%s' % i) for i in range(args.associations)]
+        statuses = [[] for _ in file_sets]
+        threads = [Thread(target=send, args=(port, list(file_set.values()), statuses[i]))
+                   for i, file_set in enumerate(file_sets)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+        print("sent %s file sets over %s associations in %.2f s" % (len(file_sets), len(threads), elapsed))
+
+        check(all(status == SUCCESS for file_statuses in statuses for status in file_statuses) and
+              all(len(file_statuses) == 3 for file_statuses in statuses), "every C-STORE succeeded", failures)
+        for i, file_set in enumerate(file_sets):
+            file_paths = [join(inbox_dir, 'PATIENT_%s' % i, '%s.dcm' % ds.SOPInstanceUID) for ds in file_set.values()]
+            check(all(isfile(path) for path in file_paths), "files of PATIENT_%s written" % i, failures)
+        plans = receiver.plans
+        check(len(plans) == len(file_sets), "%s of %s plans registered" % (len(plans), len(file_sets)), failures)
+
+        # objects that must not be written outside of the inbox
+        invalid_uid = copy_file_set(source, 'INVALID')['rtstruct']
+        invalid_uid.SOPInstanceUID = invalid_uid.file_meta.MediaStorageSOPInstanceUID = '1.2.3/../../evil'
+        traversal = copy_file_set(source, '../../evil')['rtstruct']
+        statuses = []
+        send(port, [invalid_uid, traversal], statuses)
+        check(statuses[0] not in {None, SUCCESS}, "invalid SOPInstanceUID refused", failures)
+        check(statuses[1] == SUCCESS, "PatientID with a path accepted", failures)
+        written = [join(path, file_name) for path, _, file_names in walk(root) for file_name in file_names]
+        check(all(path.startswith(inbox_dir) for path in written), "nothing written outside of the inbox", failures)
+        check(not any(path.endswith(PARTIAL_FILE_SUFFIX) for path in written), "no partial files left", failures)
+
+        # a file set copied into the inbox, instead of being sent, is found by a rescan
+        copied_dir = join(inbox_dir, 'COPIED')
+        makedirs(copied_dir)
+        for modality, ds in copy_file_set(source, 'COPIED').items():
+            ds.save_as(join(copied_dir, '%s.dcm' % modality))
+        receiver.rescan()
+        plans = receiver.plans
+        check(len(plans) == len(file_sets) + 1, "copied plan found by rescan, %s plans" % len(plans), failures)
+    finally:
+        receiver.stop()
+
+    if failures:
+        sys.exit("%s check(s) failed" % len(failures))
+
+
+if __name__ == '__main__':
+    main()
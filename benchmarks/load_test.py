@@ -0,0 +1,153 @@
+"""
+Load test of concurrent score card sessions, run from the repository root:
+    python benchmarks/load_test.py --sessions 10 --actions 50 --inbox path/to/dicom
+
+Each simulated session is a ScoreCardView attached to its own Bokeh Document, as the server creates per browser
+tab. Sessions take turns performing random user actions (pick a plan, switch protocol or fractionation, override an
+ROI, calculate), as their callbacks would be serialized on the server's single IOLoop thread. A selection always
+changes the widget value, as Bokeh only runs callbacks on a change; actions with nothing to change are not timed.
+Callback latency, throughput and memory per session are reported, and the first traceback of each failing action.
+"""
+from __future__ import print_function
+from os.path import join, dirname, abspath
+import argparse
+import random
+import sys
+import tempfile
+import time
+import traceback
+import tracemalloc
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'dvh-check'))
+from bokeh.document import Document  # noqa: E402
+from app_context import get_app_context  # noqa: E402
+from history import ScoreCardHistory  # noqa: E402
+from paths import INBOX_DIR  # noqa: E402
+from utilities import DicomDirectoryParser  # noqa: E402
+from view import ScoreCardView  # noqa: E402
+
+
+def create_session(plans):
+    doc = Document()
+    view = ScoreCardView(doc=doc)
+    doc.add_root(view.layout)
+    # the inbox is scanned once for all sessions, next tick callbacks only run inside a Bokeh server
+    view.plans = plans
+    view.select_plan.options = list(plans)
+    return view
+
+
+# Actions -------------------------------------------------------------------
+# each returns False if there was nothing to change, e.g. a single plan is already selected
+def select_new_value(select, options=None):
+    options = [option for option in (options or select.options) if option != select.value]
+    if not options:
+        return False
+    select.value = random.choice(options)
+    return True
+
+
+def select_plan(view):
+    return select_new_value(view.select_plan)
+
+
+def select_protocol(view):
+    return select_new_value(view.select_protocol)
+
+
+def select_fx(view):
+    return select_new_value(view.select_fx)
+
+
+def override_roi(view):
+    if not view.roi_names or view.dvh is None:
+        return False
+    view.select_roi_template.value = random.choice(view.select_roi_template.options)
+    return select_new_value(view.select_roi, view.roi_names)
+
+
+def calculate(view):
+    view.initialize_source_data()  # matches ROIs then runs calculate_dvhs
+    return True
+
+
+ACTIONS = {'select_plan': select_plan,
+           'select_protocol': select_protocol,
+           'select_fx': select_fx,
+           'override_roi': override_roi,
+           'calculate': calculate}
+
+
+# Reporting -------------------------------------------------------------------
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(int(round(p / 100. * (len(values) - 1))), len(values) - 1)]
+
+
+def print_report(latencies, errors, elapsed, session_count, memory_per_session):
+    all_latencies = [latency for values in latencies.values() for latency in values]
+    print("%-16s %7s %10s %10s %10s %7s" % ('callback', 'count', 'p50 (ms)', 'p95 (ms)', 'max (ms)', 'errors'))
+    for action in sorted(latencies):
+        values = latencies[action]
+        print("%-16s %7s %10.1f %10.1f %10.1f %7s" % (action, len(values), percentile(values, 50) * 1e3,
+                                                      percentile(values, 95) * 1e3, max(values or [0]) * 1e3,
+                                                      errors[action]))
+    print("%-16s %7s %10.1f %10.1f %10.1f %7s" % ('all', len(all_latencies), percentile(all_latencies, 50) * 1e3,
+                                                  percentile(all_latencies, 95) * 1e3,
+                                                  max(all_latencies or [0]) * 1e3, sum(errors.values())))
+    print()
+    print("sessions:            %s" % session_count)
+    print("throughput:          %.1f callbacks/s" % (len(all_latencies) / elapsed))
+    print("memory per session:  %.2f MB" % (memory_per_session / 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of concurrent DVH-Check score card sessions')
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--actions', type=int, default=50, help='actions per session')
+    parser.add_argument('--inbox', default=INBOX_DIR, help='DICOM directory to score plans from')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    app_context = get_app_context()
+    app_context.history = ScoreCardHistory(join(tempfile.mkdtemp(), 'history.db'))  # keep results out of the app
+
+    plans = DicomDirectoryParser(args.inbox).plans
+    if not plans:
+        sys.exit("No complete plan file sets found in %s" % args.inbox)
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    sessions = [create_session(plans) for _ in range(args.sessions)]
+    for view in sessions:
+        view.select_plan.value = view.select_plan.options[0]  # every session starts with a calculated plan
+    memory_per_session = (tracemalloc.get_traced_memory()[0] - baseline) / float(args.sessions)
+    tracemalloc.stop()
+
+    latencies = {action: [] for action in ACTIONS}
+    errors = {action: 0 for action in ACTIONS}
+    start = time.time()
+    for _ in range(args.actions):
+        for view in sessions:
+            action = random.choice(list(ACTIONS))
+            callback_start = time.time()
+            try:
+                changed = ACTIONS[action](view)
+            except Exception:
+                errors[action] += 1
+                if errors[action] == 1:
+                    print("First error in %s:" % action, file=sys.stderr)
+                    traceback.print_exc()
+                continue
+            if changed:
+                latencies[action].append(time.time() - callback_start)
+    elapsed = time.time() - start
+
+    print_report(latencies, errors, elapsed, args.sessions, memory_per_session)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+from protocols import Protocols
+from structure_aliases import StructureAliases
+from history import ScoreCardHistory
+
+
+class AppContext:
+    """Read-mostly objects shared by every session served by this process"""
+    def __init__(self):
+        self.protocols = Protocols()
+        self.aliases = StructureAliases()
+        self._history = None
+        self.dicom_receiver = None
+
+    @property
+    def history(self):
+        # created on first use, so scoring alone (e.g. score_service workers) does not create the database
+        if self._history is None:
+            self._history = ScoreCardHistory()
+        return self._history
+
+    @history.setter
+    def history(self, history):
+        self._history = history
+
+    def start_dicom_receiver(self):
+        from dicom_receiver import DicomReceiver
+        self.dicom_receiver = DicomReceiver()
+        self.dicom_receiver.start()
+
+    def stop_dicom_receiver(self):
+        if self.dicom_receiver is not None:
+            self.dicom_receiver.stop()
+            self.dicom_receiver = None
+
+
+_app_context = None
+
+
+def get_app_context():
+    global _app_context
+    if _app_context is None:
+        _app_context = AppContext()
+    return _app_context
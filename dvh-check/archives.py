@@ -0,0 +1,117 @@
+from os.path import isfile
+from datetime import datetime
+from functools import lru_cache
+from io import BytesIO
+import re
+import tarfile
+import zipfile
+import options
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz')
+ARCHIVE_PATH_PATTERN = re.compile(r'^(.+?(?:\.zip|\.tar|\.tar\.gz|\.tgz))/(.+)$', re.IGNORECASE)
+
+
+def is_archive(file_path):
+    return file_path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def split_archive_path(file_path):
+    """
+    Archive members are addressed as virtual files, i.e. <archive path>/<member name>
+    :return: archive path and member name, or (None, None) if file_path is not an archive member
+    """
+    match = ARCHIVE_PATH_PATTERN.match(file_path)
+    if match and isfile(match.group(1)):
+        return match.group(1), match.group(2)
+    return None, None
+
+
+def is_archive_member(file_path):
+    return split_archive_path(file_path)[0] is not None
+
+
+def get_archive_member_paths(archive_path):
+    try:
+        if archive_path.lower().endswith('.zip'):
+            with zipfile.ZipFile(archive_path) as archive:
+                names = [info.filename for info in archive.infolist() if not info.is_dir()]
+        else:
+            with tarfile.open(archive_path) as archive:
+                names = [member.name for member in archive.getmembers() if member.isfile()]
+    except (zipfile.BadZipFile, tarfile.TarError):
+        return []
+    return ["%s/%s" % (archive_path, name) for name in names]
+
+
+class ArchiveReader:
+    """Keeps each archive open for the duration of a scan, so members are read without re-opening the archive"""
+    def __init__(self):
+        self.archives = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_archive(self, archive_path):
+        if archive_path not in self.archives:
+            if archive_path.lower().endswith('.zip'):
+                self.archives[archive_path] = zipfile.ZipFile(archive_path)
+            else:
+                self.archives[archive_path] = tarfile.open(archive_path)
+        return self.archives[archive_path]
+
+    def open(self, file_path):
+        """Return a file handle to an archive member, members are streamed rather than extracted"""
+        archive_path, member_name = split_archive_path(file_path)
+        archive = self.get_archive(archive_path)
+        if isinstance(archive, zipfile.ZipFile):
+            return archive.open(member_name)
+        return archive.extractfile(member_name)
+
+    def get_mtime(self, file_path):
+        archive_path, member_name = split_archive_path(file_path)
+        archive = self.get_archive(archive_path)
+        if isinstance(archive, zipfile.ZipFile):
+            return datetime(*archive.getinfo(member_name).date_time).timestamp()
+        return float(archive.getmember(member_name).mtime)
+
+    def close(self):
+        for archive in self.archives.values():
+            archive.close()
+        self.archives = {}
+
+
+def read_dicom_dataset(file_path, stop_before_pixels=False, force=False):
+    """Read a DICOM file, archive member headers are streamed from the archive without reading the whole member"""
+    import pydicom as dicom
+    if is_archive_member(file_path):
+        if not stop_before_pixels:
+            return read_archive_member(file_path)
+        with ArchiveReader() as reader:
+            with reader.open(file_path) as document:
+                return dicom.read_file(document, stop_before_pixels=True, force=force)
+    return dicom.read_file(file_path, stop_before_pixels=stop_before_pixels, force=force)
+
+
+@lru_cache(maxsize=options.ARCHIVE_MEMBER_CACHE_SIZE)
+def read_archive_member(file_path):
+    """
+    Complete Dataset of an archive member, cached as a DVH is calculated per ROI and a .tar.gz member would
+    otherwise be decompressed again for each one
+    """
+    import pydicom as dicom
+    with ArchiveReader() as reader:
+        with reader.open(file_path) as document:
+            return dicom.read_file(BytesIO(document.read()), force=True)
+
+
+def get_dicompyler_input(file_path):
+    """
+    :return: file_path for files on disk, or a pydicom Dataset of an archive member, both are accepted by
+    dicompylercore.dicomparser.DicomParser
+    """
+    if is_archive_member(file_path):
+        return read_archive_member(file_path)
+    return file_path
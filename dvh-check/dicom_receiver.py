@@ -0,0 +1,131 @@
+from os import makedirs, fdopen, replace, remove
+from os.path import join, getmtime, abspath, commonpath, dirname
+from threading import Lock
+import re
+import tempfile
+from utilities import DicomDirectoryParser, PARTIAL_FILE_SUFFIX
+from paths import INBOX_DIR
+import options
+
+SUCCESS = 0x0000
+OUT_OF_RESOURCES = 0xA700
+CANNOT_UNDERSTAND = 0xC000
+
+UID_PATTERN = re.compile(r'^(0|[1-9][0-9]*)(\.(0|[1-9][0-9]*))*$')
+UID_MAX_LENGTH = 64
+
+
+def get_store_path(inbox_dir, ds):
+    """
+    Path of a received object, <inbox_dir>/<PatientID>/<SOPInstanceUID>.dcm. Both values come from the sender, so
+    they are validated rather than trusted as path components
+    :raises ValueError: if the SOPInstanceUID is not a valid UID or the path would leave inbox_dir
+    """
+    uid = str(ds.SOPInstanceUID)
+    if len(uid) > UID_MAX_LENGTH or not UID_PATTERN.match(uid):
+        raise ValueError("Invalid SOPInstanceUID: %r" % uid)
+
+    patient_dir = re.sub(r'[^A-Za-z0-9._-]', '_', str(getattr(ds, 'PatientID', '')))
+    if patient_dir.strip('.') == '':  # also rejects '.' and '..'
+        patient_dir = 'UNKNOWN'
+
+    inbox_dir = abspath(inbox_dir)
+    file_path = abspath(join(inbox_dir, patient_dir, "%s.dcm" % uid))
+    if commonpath([inbox_dir, file_path]) != inbox_dir:
+        raise ValueError("Received object would be written outside of the inbox: %s" % file_path)
+    return file_path
+
+
+class DicomReceiver:
+    """
+    Storage SCP that writes RT objects to the inbox and registers them with a DicomDirectoryParser as they arrive,
+    so received plans are available without rescanning the inbox
+    """
+    def __init__(self, inbox_dir=INBOX_DIR, ae_title=options.DICOM_SCP_AE_TITLE, address=options.DICOM_SCP_ADDRESS,
+                 port=options.DICOM_SCP_PORT, max_associations=options.DICOM_SCP_MAX_ASSOCIATIONS):
+        self.inbox_dir = inbox_dir
+        self.ae_title = ae_title
+        self.address = address
+        self.port = port
+        self.max_associations = max_associations
+
+        # Each association is handled in its own thread by pynetdicom
+        self.lock = Lock()
+        self.parser = DicomDirectoryParser(inbox_dir)
+        self.server = None
+
+    def start(self):
+        from pynetdicom import AE, evt
+        from pynetdicom.sop_class import RTPlanStorage, RTStructureSetStorage, RTDoseStorage
+
+        ae = AE(ae_title=self.ae_title)
+        ae.maximum_associations = self.max_associations
+        for sop_class in [RTPlanStorage, RTStructureSetStorage, RTDoseStorage]:
+            ae.add_supported_context(sop_class)
+
+        self.server = ae.start_server((self.address, self.port), block=False,
+                                      evt_handlers=[(evt.EVT_C_STORE, self.handle_store)])
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+    @property
+    def is_running(self):
+        return self.server is not None
+
+    def handle_store(self, event):
+        ds = event.dataset
+        ds.file_meta = event.file_meta
+
+        try:
+            file_path = get_store_path(self.inbox_dir, ds)
+        except ValueError:
+            return CANNOT_UNDERSTAND
+
+        try:
+            self.save(ds, file_path)
+        except OSError:
+            return OUT_OF_RESOURCES
+
+        with self.lock:
+            if file_path not in self.parser.dicom_tag_values:  # a re-sent object only overwrites its file
+                self.parser.add_dataset(file_path, ds, getmtime(file_path))
+
+        return SUCCESS
+
+    @staticmethod
+    def save(ds, file_path):
+        """Write to a partial file first, so an inbox scan never reads a file that is still being written"""
+        makedirs(dirname(file_path), exist_ok=True)
+        fd, partial_path = tempfile.mkstemp(suffix=PARTIAL_FILE_SUFFIX, dir=dirname(file_path))
+        try:
+            with fdopen(fd, 'wb') as document:
+                ds.save_as(document, write_like_original=False)
+            replace(partial_path, file_path)
+        except BaseException:
+            remove(partial_path)
+            raise
+
+    def rescan(self, parser=None):
+        """
+        Replace the index with a rescan of the inbox, which finds files copied in rather than received, keeping the
+        objects received in the meantime
+        :param parser: DicomDirectoryParser of a finished scan of the inbox, e.g. run one plan at a time by the view,
+        else the inbox is scanned now
+        """
+        if parser is None:
+            parser = DicomDirectoryParser(self.inbox_dir)
+        with self.lock:
+            for file_path, record in self.parser.dicom_tag_values.items():
+                if file_path not in parser.dicom_tag_values:
+                    ds = parser.read_dicom_file(file_path)
+                    if ds is not None:
+                        parser.add_dataset(file_path, ds, record.timestamp)
+            self.parser = parser
+
+    @property
+    def plans(self):
+        with self.lock:
+            return self.parser.plans
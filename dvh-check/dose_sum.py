@@ -0,0 +1,183 @@
+from copy import deepcopy
+from functools import lru_cache
+from archives import read_dicom_dataset, get_dicompyler_input
+import options
+
+MAX_PIXEL_VALUE = 2 ** 32 - 1
+
+
+class DoseGrid:
+    """Dose in Gy indexed [z, y, x], with the patient coordinates (mm) along each axis in increasing order"""
+    def __init__(self, values, x, y, z):
+        self.values = values
+        self.x = x
+        self.y = y
+        self.z = z
+
+    @classmethod
+    def from_dataset(cls, ds):
+        import numpy as np
+        if [round(float(v)) for v in ds.ImageOrientationPatient] != [1, 0, 0, 0, 1, 0]:
+            raise ValueError("Only axis aligned dose grids can be summed")
+
+        values = ds.pixel_array.astype(np.float32) * np.float32(ds.DoseGridScaling)
+        if values.ndim == 2:
+            values = values[np.newaxis]
+        x0, y0, z0 = [float(v) for v in ds.ImagePositionPatient]
+        dy, dx = [float(v) for v in ds.PixelSpacing]
+        x = x0 + dx * np.arange(values.shape[2])
+        y = y0 + dy * np.arange(values.shape[1])
+        offsets = np.array([float(v) for v in ds.GridFrameOffsetVector])
+        # as in dicompylercore, offsets are relative to z0 when the first one is 0, else absolute
+        z = z0 + offsets if offsets[0] == 0 else offsets
+
+        if z.size > 1 and z[1] < z[0]:
+            z, values = z[::-1], values[::-1]
+
+        return cls(values, x, y, z)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    def has_geometry(self, other):
+        import numpy as np
+        return self.shape == other.shape and all(np.allclose(a, b) for a, b in
+                                                 [(self.x, other.x), (self.y, other.y), (self.z, other.z)])
+
+
+def get_common_axis(axes):
+    """Union of the extent of each axis, sampled at the finest spacing of any of them"""
+    import numpy as np
+    start = min(axis[0] for axis in axes)
+    stop = max(axis[-1] for axis in axes)
+    spacings = [np.min(np.diff(axis)) for axis in axes if axis.size > 1]
+    spacing = min(spacings) if spacings else 1.
+    count = int(np.floor((stop - start) / spacing + 1e-6)) + 1
+    return start + spacing * np.arange(count)
+
+
+def get_axis_interpolation(source_axis, target_axis):
+    """
+    :return: the slice of target_axis within source_axis, and for each coordinate in it the lower and upper
+    neighbour indices into source_axis and the weight of the upper neighbour
+    """
+    import numpy as np
+    tolerance = 1e-3
+    inside = np.flatnonzero((target_axis >= source_axis[0] - tolerance) &
+                            (target_axis <= source_axis[-1] + tolerance))
+    if not inside.size:
+        return slice(0, 0), None, None, None
+    inside = slice(inside[0], inside[-1] + 1)
+
+    position = np.interp(target_axis[inside], source_axis, np.arange(source_axis.size))
+    lower = np.floor(position).astype(np.intp)
+    upper = np.minimum(lower + 1, source_axis.size - 1)
+    weight = (position - lower).astype(np.float32)
+    return inside, lower, upper, weight
+
+
+def resample(grid, x, y, z, out=None, chunk_size=options.DOSE_SUM_CHUNK_SLICES):
+    """
+    Trilinear interpolation of grid onto the x, y, z axes, added into out. Dose outside of grid is 0.
+    Grids are axis aligned, so the interpolation is done one axis at a time (z, then y, then x) on chunks of
+    chunk_size target slices, which bounds the temporary arrays to a few slices of the source and target grids.
+    """
+    import numpy as np
+    if out is None:
+        out = np.zeros((z.size, y.size, x.size), dtype=np.float32)
+
+    z_inside, z_lower, z_upper, z_weight = get_axis_interpolation(grid.z, z)
+    y_inside, y_lower, y_upper, y_weight = get_axis_interpolation(grid.y, y)
+    x_inside, x_lower, x_upper, x_weight = get_axis_interpolation(grid.x, x)
+    if z_lower is None or y_lower is None or x_lower is None:
+        return out
+
+    for start in range(0, z_lower.size, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        w = z_weight[chunk][:, np.newaxis, np.newaxis]
+        values = grid.values[z_lower[chunk]] * (1 - w) + grid.values[z_upper[chunk]] * w
+        w = y_weight[np.newaxis, :, np.newaxis]
+        values = values[:, y_lower] * (1 - w) + values[:, y_upper] * w
+        w = x_weight[np.newaxis, np.newaxis, :]
+        values = values[:, :, x_lower] * (1 - w) + values[:, :, x_upper] * w
+
+        z_slice = slice(z_inside.start + start, z_inside.start + start + values.shape[0])
+        out[z_slice, y_inside, x_inside] += values
+
+    return out
+
+
+def sum_dose_grids(grids, chunk_size=options.DOSE_SUM_CHUNK_SLICES):
+    """Sum grids on their common geometry, grids that already share a geometry are added without resampling"""
+    if all(grid.has_geometry(grids[0]) for grid in grids[1:]):
+        values = grids[0].values.copy()
+        for grid in grids[1:]:
+            values += grid.values
+        return DoseGrid(values, grids[0].x, grids[0].y, grids[0].z)
+
+    x = get_common_axis([grid.x for grid in grids])
+    y = get_common_axis([grid.y for grid in grids])
+    z = get_common_axis([grid.z for grid in grids])
+    values = None
+    for grid in grids:
+        values = resample(grid, x, y, z, out=values, chunk_size=chunk_size)
+    return DoseGrid(values, x, y, z)
+
+
+def grid_to_dataset(grid, template_ds, summation_type):
+    """RTDOSE Dataset of grid, using template_ds for every attribute unrelated to geometry and pixel data"""
+    import numpy as np
+    from pydicom.uid import ExplicitVRLittleEndian
+    ds = deepcopy(template_ds)
+
+    max_dose = float(grid.values.max())
+    scaling = float('%.6e' % (max_dose / MAX_PIXEL_VALUE)) if max_dose > 0 else 1.
+    pixels = np.empty(grid.shape, dtype='<u4')
+    for i, frame in enumerate(grid.values):  # float64 per frame, float32 cannot represent MAX_PIXEL_VALUE
+        pixels[i] = np.clip(np.round(frame.astype(np.float64) / scaling), 0, MAX_PIXEL_VALUE)
+
+    ds.NumberOfFrames, ds.Rows, ds.Columns = grid.shape
+    ds.ImagePositionPatient = [round(float(v), 4) for v in (grid.x[0], grid.y[0], grid.z[0])]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [round(float(grid.y[1] - grid.y[0]), 4) if grid.y.size > 1 else 1.,
+                       round(float(grid.x[1] - grid.x[0]), 4) if grid.x.size > 1 else 1.]
+    ds.GridFrameOffsetVector = [round(float(v), 4) for v in grid.z - grid.z[0]]
+    ds.SamplesPerPixel = 1
+    ds.BitsAllocated = 32
+    ds.BitsStored = 32
+    ds.HighBit = 31
+    ds.PixelRepresentation = 0
+    ds.DoseGridScaling = scaling
+    ds.DoseSummationType = summation_type
+    ds.PixelData = pixels.tobytes()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    return ds
+
+
+def read_dose_dataset(dose_file):
+    return read_dicom_dataset(dose_file, force=True)
+
+
+@lru_cache(maxsize=options.DOSE_SUM_CACHE_SIZE)
+def get_summed_dose(dose_files):
+    """
+    :param dose_files: tuple of RTDOSE file paths, e.g. per-beam doses of a plan or the plan doses of a course
+    :return: pydicom Dataset of the summed dose, which dicompylercore accepts in place of a file
+    """
+    datasets = [read_dose_dataset(dose_file) for dose_file in dose_files]
+    plan_uids = {str(ds.ReferencedRTPlanSequence[0].ReferencedSOPInstanceUID) for ds in datasets
+                 if 'ReferencedRTPlanSequence' in ds}
+    summation_type = ['PLAN', 'MULTI_PLAN'][len(plan_uids) > 1]
+    grid = sum_dose_grids([DoseGrid.from_dataset(ds) for ds in datasets])
+    return grid_to_dataset(grid, datasets[0], summation_type)
+
+
+def get_dose_input(dose_file):
+    """RTDOSE input for dicompylercore, summing dose_file first if it is a list of files"""
+    if isinstance(dose_file, (list, tuple)):
+        if len(dose_file) == 1:
+            return get_dicompyler_input(dose_file[0])
+        return get_summed_dose(tuple(dose_file))
+    return get_dicompyler_input(dose_file)
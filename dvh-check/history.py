@@ -0,0 +1,132 @@
+from contextlib import closing
+from datetime import datetime
+import sqlite3
+from archives import read_dicom_dataset
+from paths import HISTORY_DB
+
+COLUMNS = ['evaluated', 'patient_id', 'patient_name', 'plan_name', 'plan_uid', 'protocol', 'fractionation',
+           'roi_template', 'roi_name', 'constraint_label', 'threshold', 'calc_type', 'value', 'pass_fail']
+
+CREATE_TABLE = """
+CREATE TABLE IF NOT EXISTS constraints (
+    evaluated TEXT NOT NULL,
+    patient_id TEXT,
+    patient_name TEXT,
+    plan_name TEXT,
+    plan_uid TEXT NOT NULL,
+    protocol TEXT NOT NULL,
+    fractionation TEXT NOT NULL,
+    roi_template TEXT NOT NULL,
+    roi_name TEXT,
+    constraint_label TEXT NOT NULL,
+    threshold TEXT,
+    calc_type TEXT,
+    value REAL,
+    pass_fail TEXT,
+    PRIMARY KEY (plan_uid, protocol, fractionation, roi_template, constraint_label)
+)"""
+
+# The primary key makes a re-calculation replace its previous rows, these cover the cross-plan queries
+CREATE_INDICES = ["CREATE INDEX IF NOT EXISTS idx_constraint ON constraints "
+                  "(protocol, fractionation, roi_template, constraint_label, evaluated)",
+                  "CREATE INDEX IF NOT EXISTS idx_patient ON constraints (patient_id, evaluated)"]
+
+
+def get_plan_info(plan_files):
+    """Read patient and plan identifiers from the RTPLAN header, falling back to RTDOSE if no plan file is given"""
+    if plan_files.get('rtplan'):
+        # plan sums have a list of plan files, and are stored under their joined labels and UIDs, in UID order so
+        # the same course gets the same plan_uid whichever order its files were found in
+        plan_paths = plan_files['rtplan'] if isinstance(plan_files['rtplan'], list) else [plan_files['rtplan']]
+        datasets = [read_dicom_dataset(path, stop_before_pixels=True) for path in plan_paths]
+        datasets.sort(key=lambda plan_ds: str(plan_ds.SOPInstanceUID))
+        ds = datasets[0]
+        plan_name = ' + '.join([str(plan_ds.RTPlanLabel) for plan_ds in datasets])
+        plan_uid = '+'.join([str(plan_ds.SOPInstanceUID) for plan_ds in datasets])
+    else:
+        dose_paths = plan_files['rtdose'] if isinstance(plan_files['rtdose'], list) else [plan_files['rtdose']]
+        datasets = [read_dicom_dataset(path, stop_before_pixels=True) for path in dose_paths]
+        ds = datasets[0]
+        plan_name = ''
+        plan_uid = '+'.join(sorted({str(ref.ReferencedSOPInstanceUID) for dose_ds in datasets
+                                    for ref in dose_ds.ReferencedRTPlanSequence}))
+    return {'patient_id': str(ds.PatientID), 'patient_name': str(ds.PatientName),
+            'plan_name': plan_name, 'plan_uid': plan_uid}
+
+
+class ScoreCardHistory:
+    """SQLite store of every evaluated constraint, a connection is opened per call so sessions can share it"""
+    def __init__(self, db_file=HISTORY_DB):
+        self.db_file = db_file
+        with closing(self.connect()) as cnx:
+            cnx.execute('PRAGMA journal_mode=WAL')  # readers do not block the writer
+            with cnx:
+                cnx.execute(CREATE_TABLE)
+                columns = [row[1] for row in cnx.execute('PRAGMA table_info(constraints)')]
+                if 'threshold' not in columns:  # databases created before thresholds were stored separately
+                    cnx.execute('ALTER TABLE constraints ADD COLUMN threshold TEXT')
+                for index in CREATE_INDICES:
+                    cnx.execute(index)
+
+    def connect(self):
+        return sqlite3.connect(self.db_file)
+
+    def add_score_card(self, data, plan_info, protocol, fractionation):
+        """
+        :param data: constraint table columns, as in ScoreCardView.source_data or scoring.score_plan
+        :param plan_info: from get_plan_info
+        """
+        evaluated = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows = []
+        for i, roi_template in enumerate(data['roi_template']):
+            if not data['roi_key'][i] or not data['pass_fail'][i]:
+                continue  # not calculated, or cleared in the view
+            rows.append((evaluated, plan_info['patient_id'], plan_info['patient_name'], plan_info['plan_name'],
+                         plan_info['plan_uid'], protocol, fractionation, roi_template, data['roi_name'][i],
+                         data['constraint_label'][i], data['threshold'][i], data['calc_type'][i],
+                         float(data['constraint_calc'][i]), data['pass_fail'][i]))
+
+        with closing(self.connect()) as cnx:
+            with cnx:
+                cnx.executemany("INSERT OR REPLACE INTO constraints (%s) VALUES (%s)" %
+                                (','.join(COLUMNS), ','.join(['?'] * len(COLUMNS))), rows)
+
+    def query(self, protocol=None, fractionation=None, roi_template=None, constraint_label=None, start=None,
+              end=None, patient_id=None):
+        """
+        :param start: inclusive lower bound of evaluation date, 'YYYY-MM-DD'
+        :param end: exclusive upper bound of evaluation date, 'YYYY-MM-DD'
+        :return: column data, keys are COLUMNS
+        """
+        conditions, params = [], []
+        for column, value in [('protocol', protocol), ('fractionation', fractionation),
+                              ('roi_template', roi_template), ('constraint_label', constraint_label),
+                              ('patient_id', patient_id)]:
+            if value is not None:
+                conditions.append("%s = ?" % column)
+                params.append(value)
+        if start is not None:
+            conditions.append("evaluated >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("evaluated < ?")
+            params.append(end)
+
+        sql = "SELECT %s FROM constraints" % ','.join(COLUMNS)
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY evaluated"
+
+        with closing(self.connect()) as cnx:
+            rows = cnx.execute(sql, params).fetchall()
+
+        return {column: [row[i] for row in rows] for i, column in enumerate(COLUMNS)}
+
+    def get_distinct(self, column, **conditions):
+        sql = "SELECT DISTINCT %s FROM constraints" % column
+        conditions = {key: value for key, value in conditions.items() if value is not None}
+        if conditions:
+            sql += " WHERE " + " AND ".join(["%s = ?" % key for key in conditions])
+        sql += " ORDER BY %s" % column
+        with closing(self.connect()) as cnx:
+            return [row[0] for row in cnx.execute(sql, list(conditions.values())).fetchall()]
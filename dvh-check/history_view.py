@@ -0,0 +1,101 @@
+from datetime import datetime
+from bokeh.layouts import column, row
+from bokeh.models.widgets import Select, Button, DataTable, TableColumn, NumberFormatter
+from bokeh.models import ColumnDataSource, HoverTool
+from bokeh.plotting import figure
+
+
+class HistoryView:
+    def __init__(self, history):
+        self.history = history
+        self.source = ColumnDataSource(data=dict(x=[], y=[], color=[], evaluated=[], patient_name=[], plan_name=[],
+                                                 roi_name=[], pass_fail=[]))
+
+        self.__define_layout_objects()
+        self.__do_bind()
+        self.__do_layout()
+
+    def __define_layout_objects(self):
+        self.select_protocol = Select(title='Protocol:')
+        self.select_fx = Select(title='Fractions:')
+        self.select_roi_template = Select(title='Template ROI:')
+        self.select_constraint = Select(title='Constraint:')
+        self.button_refresh = Button(label='Refresh History', button_type='primary')
+
+        self.columns = [TableColumn(field='evaluated', title='Evaluated'),
+                        TableColumn(field='patient_name', title='Patient'),
+                        TableColumn(field='plan_name', title='Plan'),
+                        TableColumn(field='roi_name', title='ROI'),
+                        TableColumn(field='y', title='Value', formatter=NumberFormatter(format="0.00")),
+                        TableColumn(field='pass_fail', title='Pass/Fail')]
+        self.data_table = DataTable(source=self.source, columns=self.columns, index_position=None,
+                                    width=1000, height=300)
+
+        tools = "pan,wheel_zoom,box_zoom,reset,crosshair,save"
+        self.plot = figure(plot_width=1050, plot_height=500, tools=tools, active_drag="box_zoom",
+                           x_axis_type='datetime')
+        self.plot.add_tools(HoverTool(show_arrow=False,
+                                      tooltips=[('Patient', '@patient_name'),
+                                                ('Plan', '@plan_name'),
+                                                ('Evaluated', '@evaluated'),
+                                                ('Value', '@y')]))
+        self.plot.circle('x', 'y', source=self.source, color='color', size=8, alpha=0.7)
+
+    def __do_bind(self):
+        self.button_refresh.on_click(self.refresh)
+        self.select_protocol.on_change('value', self.filter_listener)
+        self.select_fx.on_change('value', self.filter_listener)
+        self.select_roi_template.on_change('value', self.filter_listener)
+        self.select_constraint.on_change('value', self.constraint_listener)
+
+    def __do_layout(self):
+        self.layout = column(row(self.select_protocol, self.select_fx),
+                             row(self.select_roi_template, self.select_constraint),
+                             self.button_refresh,
+                             self.plot,
+                             self.data_table)
+
+    # Listeners -------------------------------------------------------------------
+    def filter_listener(self, attr, old, new):
+        self.update_options()
+        self.update_source()  # select_constraint may keep its value, e.g. the same label in another protocol
+
+    def constraint_listener(self, attr, old, new):
+        self.update_source()
+
+    # Methods -------------------------------------------------------------------
+    def refresh(self):
+        self.update_options()
+        self.update_source()
+
+    @staticmethod
+    def update_select(select, options):
+        select.options = options
+        if select.value not in options:
+            select.value = options[0] if options else ''
+
+    def update_options(self):
+        # each select is narrowed by the ones above it, changing a value cascades through filter_listener
+        self.update_select(self.select_protocol, self.history.get_distinct('protocol'))
+        self.update_select(self.select_fx, self.history.get_distinct('fractionation',
+                                                                     protocol=self.select_protocol.value))
+        self.update_select(self.select_roi_template,
+                           self.history.get_distinct('roi_template', protocol=self.select_protocol.value,
+                                                     fractionation=self.select_fx.value))
+        self.update_select(self.select_constraint,
+                           self.history.get_distinct('constraint_label', protocol=self.select_protocol.value,
+                                                     fractionation=self.select_fx.value,
+                                                     roi_template=self.select_roi_template.value))
+
+    def update_source(self):
+        data = self.history.query(protocol=self.select_protocol.value, fractionation=self.select_fx.value,
+                                  roi_template=self.select_roi_template.value,
+                                  constraint_label=self.select_constraint.value)
+        self.source.data = {'x': [datetime.strptime(t, '%Y-%m-%d %H:%M:%S') for t in data['evaluated']],
+                            'y': data['value'],
+                            'color': [['red', 'green'][status == 'Pass'] for status in data['pass_fail']],
+                            'evaluated': data['evaluated'],
+                            'patient_name': data['patient_name'],
+                            'plan_name': data['plan_name'],
+                            'roi_name': data['roi_name'],
+                            'pass_fail': data['pass_fail']}
@@ -1,8 +1,21 @@
 from bokeh.io import curdoc
+from bokeh.models.widgets import Panel, Tabs
 from view import ScoreCardView
+from history_view import HistoryView
 
 
 view = ScoreCardView()
+history_view = HistoryView(view.history)
 
-curdoc().add_root(view.layout)
+
+def tabs_listener(attr, old, new):
+    if tabs.tabs[new].child is history_view.layout:
+        history_view.refresh()  # only query the history store once it is viewed
+
+
+tabs = Tabs(tabs=[Panel(child=view.layout, title='Score Card'),
+                  Panel(child=history_view.layout, title='History')])
+tabs.on_change('active', tabs_listener)
+
+curdoc().add_root(tabs)
 curdoc().title = 'University of Chicago Radiation Oncology - DICOM Score Card'
@@ -0,0 +1,21 @@
+# Embedded DICOM storage SCP, receives RTPLAN/RTSTRUCT/RTDOSE pushes into INBOX_DIR (requires pynetdicom)
+DICOM_SCP_ENABLED = False
+DICOM_SCP_AE_TITLE = 'DVH_CHECK'
+DICOM_SCP_ADDRESS = '127.0.0.1'
+DICOM_SCP_PORT = 11112
+DICOM_SCP_MAX_ASSOCIATIONS = 10
+
+# HTTP/JSON scoring service (score_service.py)
+SCORING_SERVICE_ADDRESS = '127.0.0.1'
+SCORING_SERVICE_PORT = 5007
+SCORING_SERVICE_WORKERS = 4
+SCORING_SERVICE_CACHE_SIZE = 256
+SCORING_SERVICE_JOB_HISTORY = 1000
+SCORING_SERVICE_RESCAN_INTERVAL = 10  # minimum seconds between inbox rescans for unknown SOPInstanceUIDs
+
+# Dose summation (dose_sum.py), z slices resampled per chunk and number of summed grids kept in memory
+DOSE_SUM_CHUNK_SLICES = 8
+DOSE_SUM_CACHE_SIZE = 2
+
+# Complete archive members (e.g. RTSTRUCT and RTDOSE of the selected plan) kept in memory for DVH calculations
+ARCHIVE_MEMBER_CACHE_SIZE = 4
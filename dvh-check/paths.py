@@ -4,3 +4,4 @@ SCRIPT_DIR = dirname(__file__)
 PROTOCOL_DIR = join(SCRIPT_DIR, 'protocols')
 INBOX_DIR = join(SCRIPT_DIR, 'test_files')
 ALIASES_FILE = join(PROTOCOL_DIR, 'aliases.csv')
+HISTORY_DB = join(SCRIPT_DIR, 'history.db')
@@ -59,8 +59,8 @@ class Protocols:
 
     def get_column_data(self, protocol_name, fractionation):
         roi_template = []
-        keys = ['string_rep', 'operator', 'input_value', 'input_units', 'input_type', 'output_units', 'output_type',
-                'input_scale', 'output_scale', 'threshold_value', 'calc_type']
+        keys = ['string_rep', 'constraint_label', 'threshold', 'operator', 'input_value', 'input_units', 'input_type',
+                'output_units', 'output_type', 'input_scale', 'output_scale', 'threshold_value', 'calc_type']
         data = {key: [] for key in keys}
 
         for roi in self.get_rois(protocol_name, fractionation):
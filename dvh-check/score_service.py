@@ -0,0 +1,262 @@
+"""
+HTTP/JSON scoring service, evaluates protocol constraints without the Bokeh UI
+
+POST /jobs      {"files": {"rtstruct": path, "rtdose": path or [paths to sum]}}, paths within the inbox, or
+                {"sop_instance_uids": {"rtstruct": uid, "rtdose": uid}} or {"sop_instance_uids": {"rtplan": uid}},
+                plus "protocol", "fractionation" and optionally "roi_override": {template_roi: plan_roi}
+GET  /jobs/<id> job status, with the constraint table under "result" once done
+"""
+from __future__ import print_function
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from os.path import join, realpath, commonpath
+from uuid import uuid4
+import argparse
+import asyncio
+import json
+import time
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
+from tornado.web import Application, RequestHandler, HTTPError
+from app_context import get_app_context
+from archives import read_dicom_dataset
+from history import get_plan_info
+from paths import INBOX_DIR
+from scoring import score_plan, get_fractionation_key
+from utilities import DicomDirectoryParser
+import options
+
+
+class ScoringJob:
+    def __init__(self, key, request):
+        self.job_id = uuid4().hex
+        self.key = key
+        self.request = request
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+
+    def to_dict(self):
+        return {'job_id': self.job_id, 'status': self.status, 'request': self.request,
+                'result': self.result, 'error': self.error}
+
+
+class ScoringService:
+    """
+    Runs score_plan jobs on a bounded process pool. Identical requests share one in-flight job and finished
+    results are cached by the SOPInstanceUIDs of their input files.
+    Requests are resolved to files (header reads, inbox scans) and history is saved on a single resolver thread,
+    which owns the inbox index; job state is only touched from the IOLoop thread, so no locking is needed.
+    """
+    def __init__(self, inbox_dir=INBOX_DIR, max_workers=options.SCORING_SERVICE_WORKERS,
+                 cache_size=options.SCORING_SERVICE_CACHE_SIZE):
+        self.inbox_dir = inbox_dir
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.resolver = ThreadPoolExecutor(max_workers=1)
+        self.cache_size = cache_size
+
+        self.jobs = OrderedDict()  # job_id: ScoringJob, oldest first
+        self.in_flight = {}  # key: ScoringJob
+        self.results = OrderedDict()  # key: constraint table, least recently used first
+        self.parser = None
+        self.files_by_uid = {}
+        self.last_scan = None
+
+    # Input resolution -------------------------------------------------------------
+    def get_inbox_file_path(self, file_path):
+        """Resolve a requested path, absolute or relative to the inbox, which must not be outside of the inbox"""
+        if isinstance(file_path, list):
+            return [self.get_inbox_file_path(path) for path in file_path]
+        if not isinstance(file_path, str):
+            raise TypeError("file paths must be strings")
+        inbox_dir = realpath(self.inbox_dir)
+        resolved = realpath(join(inbox_dir, file_path))
+        if commonpath([inbox_dir, resolved]) != inbox_dir:
+            raise HTTPError(403, reason="Only files within the inbox can be scored")
+        return resolved
+
+    def get_file_path(self, uid):
+        if uid not in self.files_by_uid and self.can_rescan:
+            self.scan_inbox()  # rescan only for unknown UIDs, at most once per SCORING_SERVICE_RESCAN_INTERVAL
+        if uid not in self.files_by_uid:
+            raise HTTPError(404, reason="SOPInstanceUID %s not found in inbox" % uid)
+        return self.files_by_uid[uid]
+
+    @property
+    def can_rescan(self):
+        return self.last_scan is None or time.time() - self.last_scan >= options.SCORING_SERVICE_RESCAN_INTERVAL
+
+    def scan_inbox(self):
+        self.last_scan = time.time()
+        self.parser = DicomDirectoryParser(self.inbox_dir)
+        self.files_by_uid = {record.sop_instance_uid: file_path
+                             for file_path, record in self.parser.dicom_tag_values.items()}
+
+    def get_plan_files_by_uid(self, uids):
+        if 'rtplan' in uids and not {'rtstruct', 'rtdose'}.issubset(uids):
+            self.get_file_path(uids['rtplan'])
+            for plan_name in self.parser.plan_names:
+                plan_file_set = self.parser.plan_file_sets[plan_name]
+                if plan_file_set['rtplan']['sop_instance_uid'] == uids['rtplan']:
+                    return {file_type: plan_file_set[file_type]['file_path'] for file_type in ['rtstruct', 'rtdose']}
+            raise HTTPError(404, reason="No complete plan file set for RTPLAN %s" % uids['rtplan'])
+        files = {'rtstruct': self.get_file_path(uids['rtstruct'])}
+        if isinstance(uids['rtdose'], list):  # doses to be summed
+            files['rtdose'] = [self.get_file_path(uid) for uid in uids['rtdose']]
+        else:
+            files['rtdose'] = self.get_file_path(uids['rtdose'])
+        return files
+
+    @staticmethod
+    def check_modality(file_type, modality):
+        # e.g. an RTSTRUCT sent as the dose would be scored without error, with every constraint passing
+        if modality != file_type:
+            raise HTTPError(400, reason="The %s file is not an %s" % (file_type, file_type.upper()))
+
+    @staticmethod
+    def get_sop_instance_uid(file_path, file_type):
+        from pydicom.errors import InvalidDicomError
+        if isinstance(file_path, list):
+            return tuple([ScoringService.get_sop_instance_uid(path, file_type) for path in file_path])
+        try:
+            ds = read_dicom_dataset(file_path, stop_before_pixels=True)
+        except InvalidDicomError:
+            raise HTTPError(400, reason="The %s file is not a DICOM file" % file_type)
+        ScoringService.check_modality(file_type, str(getattr(ds, 'Modality', '')).lower())
+        return str(ds.SOPInstanceUID)
+
+    def get_indexed_uid(self, file_path, file_type):
+        if isinstance(file_path, list):
+            return tuple([self.get_indexed_uid(path, file_type) for path in file_path])
+        record = self.parser.dicom_tag_values[file_path]
+        self.check_modality(file_type, record.modality)
+        return record.sop_instance_uid
+
+    def parse_request(self, request):
+        try:
+            protocol = request['protocol']
+            if not isinstance(protocol, str):
+                raise TypeError("protocol must be a string")
+            fractionation = get_fractionation_key(request['fractionation'])
+            roi_override = request.get('roi_override') or {}
+            if not isinstance(roi_override, dict) or \
+                    not all(isinstance(roi, str) for roi in list(roi_override) + list(roi_override.values())):
+                raise TypeError("roi_override must map template ROI names to plan ROI names")
+            if 'files' in request:
+                files = {file_type: self.get_inbox_file_path(request['files'][file_type])
+                         for file_type in ['rtstruct', 'rtdose']}
+                uids = {file_type: self.get_sop_instance_uid(file_path, file_type)
+                        for file_type, file_path in files.items()}
+            else:
+                files = self.get_plan_files_by_uid(request['sop_instance_uids'])
+                uids = {file_type: self.get_indexed_uid(file_path, file_type) for file_type, file_path in files.items()}
+        except (KeyError, TypeError) as e:
+            raise HTTPError(400, reason="Invalid request: %s" % e)
+        except (IOError, OSError):
+            raise HTTPError(404, reason="Could not read DICOM file")
+
+        protocols = get_app_context().protocols
+        if protocol not in protocols.data or fractionation not in protocols.data[protocol]:
+            raise HTTPError(400, reason="Unknown protocol/fractionation: %s %s" % (protocol, fractionation))
+
+        key = (uids['rtstruct'], uids['rtdose'], protocol, fractionation, tuple(sorted(roi_override.items())))
+        return key, (files['rtstruct'], files['rtdose'], protocol, fractionation, roi_override)
+
+    # Jobs -------------------------------------------------------------------------
+    async def submit(self, request):
+        key, args = await IOLoop.current().run_in_executor(self.resolver, self.parse_request, request)
+
+        if key in self.in_flight:
+            return self.in_flight[key]
+
+        job = ScoringJob(key, request)
+        self.jobs[job.job_id] = job
+        self.prune_jobs()
+
+        if key in self.results:
+            self.results.move_to_end(key)
+            job.status, job.result = 'done', self.results[key]
+        else:
+            self.in_flight[key] = job
+            IOLoop.current().spawn_callback(self.run, job, args)
+
+        return job
+
+    async def run(self, job, args):
+        job.status = 'running'
+        try:
+            job.result = await asyncio.get_event_loop().run_in_executor(self.executor, score_plan, *args)
+            job.status = 'done'
+            self.results[job.key] = job.result
+            if len(self.results) > self.cache_size:
+                self.results.popitem(last=False)
+        except Exception as e:
+            job.status, job.error = 'failed', str(e)
+        finally:
+            self.in_flight.pop(job.key, None)
+
+        if job.status == 'done':
+            try:
+                await IOLoop.current().run_in_executor(self.resolver, self.save_history, job, args)
+            except Exception:
+                app_log.exception("Could not save the score card of job %s to the history", job.job_id)
+
+    @staticmethod
+    def save_history(job, args):
+        struct_file, dose_file, protocol, fractionation = args[:4]
+        plan_info = get_plan_info({'rtstruct': struct_file, 'rtdose': dose_file})
+        get_app_context().history.add_score_card(job.result, plan_info, protocol, fractionation)
+
+    def prune_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in {'done', 'failed'}]
+        for job_id in finished[:max(len(self.jobs) - options.SCORING_SERVICE_JOB_HISTORY, 0)]:
+            self.jobs.pop(job_id)
+
+    def get_job(self, job_id):
+        if job_id not in self.jobs:
+            raise HTTPError(404, reason="Unknown job %s" % job_id)
+        return self.jobs[job_id]
+
+
+class JobsHandler(RequestHandler):
+    def initialize(self, service):
+        self.service = service
+
+    async def post(self):
+        try:
+            request = json.loads(self.request.body.decode('utf-8'))
+        except ValueError:
+            raise HTTPError(400, reason="Request body is not valid JSON")
+        job = await self.service.submit(request)
+        self.set_status(202 if job.status != 'done' else 200)
+        self.write(job.to_dict())
+
+
+class JobHandler(RequestHandler):
+    def initialize(self, service):
+        self.service = service
+
+    def get(self, job_id):
+        self.write(self.service.get_job(job_id).to_dict())
+
+
+def make_app(service):
+    return Application([(r'/jobs', JobsHandler, {'service': service}),
+                        (r'/jobs/([0-9a-f]+)', JobHandler, {'service': service})])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DVH-Check scoring service')
+    parser.add_argument('--address', default=options.SCORING_SERVICE_ADDRESS,
+                        help="interface to listen on, '' for all interfaces")
+    parser.add_argument('--port', type=int, default=options.SCORING_SERVICE_PORT)
+    parser.add_argument('--workers', type=int, default=options.SCORING_SERVICE_WORKERS)
+    args = parser.parse_args()
+
+    make_app(ScoringService(max_workers=args.workers)).listen(args.port, address=args.address)
+    print("Scoring service listening on %s:%s" % (args.address or '*', args.port))
+    IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+from archives import get_dicompyler_input
+from app_context import get_app_context
+from dose_sum import get_dose_input
+
+COLUMNS = ['roi_template', 'roi_name', 'roi_key', 'volume', 'min_dose', 'mean_dose', 'max_dose', 'constraint',
+           'constraint_label', 'threshold', 'constraint_calc', 'pass_fail', 'calc_type']
+
+
+def get_structures(struct_file):
+    from dicompylercore import dicomparser
+    return dicomparser.DicomParser(get_dicompyler_input(struct_file)).GetStructures()
+
+
+def get_roi_key_map(structures):
+    roi_keys = [key for key in structures if structures[key]['type'].upper() != 'MARKER']
+    return {str(structures[key]['name']): key for key in roi_keys}
+
+
+def get_dvh(struct_file, dose_file, key):
+    from dicompylercore import dvhcalc
+    return dvhcalc.get_dvh(get_dicompyler_input(struct_file), get_dose_input(dose_file), key)
+
+
+def calculate_constraint(dvh, calc_type, input_value):
+    if calc_type == 'Volume':
+        ans = dvh.dose_constraint(input_value, volume_units='cm3')
+        return float(str(ans).split(' ')[0])
+    if calc_type == 'Dose':
+        ans = dvh.volume_constraint(input_value, dose_units='Gy')
+        return float(str(ans).split(' ')[0])
+    if calc_type == 'Mean':
+        return dvh.mean
+    if calc_type == 'MVS':
+        ans = dvh.volume_constraint(input_value, dose_units='Gy')
+        ans = float(str(ans).split(' ')[0])
+        return dvh.volume - ans
+
+    return None
+
+
+def get_pass_fail(constraint, operator, threshold):
+    if constraint is None:
+        return ''
+    if operator == '<':
+        status = constraint < threshold
+    else:
+        status = constraint > threshold
+    return ['Fail', 'Pass'][status]
+
+
+def get_fractionation_key(fractionation):
+    return "%sfx" % str(fractionation).replace('fx', '')
+
+
+def score_plan(struct_file, dose_file, protocol_name, fractionation, roi_override=None):
+    """
+    Evaluate every constraint of a protocol against a plan, as the score card table does
+    :return: column data with the same keys as ScoreCardView.source_data, None for values that were not calculated
+    """
+    app_context = get_app_context()
+    protocol_data = app_context.protocols.get_column_data(protocol_name, get_fractionation_key(fractionation))
+    roi_override = roi_override or {}
+
+    roi_key_map = get_roi_key_map(get_structures(struct_file))
+    matches = app_context.aliases.match_protocol_rois(protocol_data['roi_template'], list(roi_key_map))
+
+    data = {key: [] for key in COLUMNS}
+    dvhs = {}
+    for i, protocol_roi in enumerate(protocol_data['roi_template']):
+        match = roi_override.get(protocol_roi, matches.get(protocol_roi))
+        key = roi_key_map.get(match) if match else None
+
+        constraint, status, dvh = None, '', None
+        if key is not None:
+            if key not in dvhs:
+                dvhs[key] = get_dvh(struct_file, dose_file, key)
+            dvh = dvhs[key]
+            constraint = calculate_constraint(dvh, protocol_data['calc_type'][i], protocol_data['input_value'][i])
+            status = get_pass_fail(constraint, protocol_data['operator'][i], protocol_data['threshold_value'][i])
+
+        data['roi_template'].append(protocol_roi)
+        data['roi_name'].append(match or '')
+        data['roi_key'].append(key)
+        data['volume'].append(None if dvh is None else float(dvh.volume))
+        data['min_dose'].append(None if dvh is None else float(dvh.min))
+        data['mean_dose'].append(None if dvh is None else float(dvh.mean))
+        data['max_dose'].append(None if dvh is None else float(dvh.max))
+        data['constraint'].append(protocol_data['string_rep'][i])
+        data['constraint_label'].append(protocol_data['constraint_label'][i])
+        data['threshold'].append(protocol_data['threshold'][i])
+        data['constraint_calc'].append(None if constraint is None else float(constraint))
+        data['pass_fail'].append(status)
+        data['calc_type'].append(protocol_data['calc_type'][i])
+
+    return data
@@ -0,0 +1,13 @@
+from app_context import get_app_context
+import options
+
+
+def on_server_loaded(server_context):
+    # Parse protocols and aliases once per server process, before the first session is opened
+    app_context = get_app_context()
+    if options.DICOM_SCP_ENABLED:
+        app_context.start_dicom_receiver()
+
+
+def on_server_unloaded(server_context):
+    get_app_context().stop_dicom_receiver()
@@ -1,122 +1,267 @@
 from os.path import isdir, join, isfile, getmtime
 from os import walk, listdir
-import pydicom as dicom
-from pydicom.errors import InvalidDicomError
 from datetime import datetime
+from archives import ArchiveReader, is_archive, is_archive_member, get_archive_member_paths
 
+PARTIAL_FILE_SUFFIX = '.partial'  # files still being written, e.g. by DicomReceiver, are not scanned
 
-def get_file_paths(start_path, search_subfolders=True):
+
+def iter_file_paths(start_path, search_subfolders=True, search_archives=True):
     if isdir(start_path):
         if search_subfolders:
-            file_paths = []
-            for root, dirs, files in walk(start_path, topdown=False):
-                for name in files:
-                    file_paths.append(join(root, name))
-            return file_paths
+            file_paths = (join(root, name) for root, dirs, files in walk(start_path, topdown=False) for name in files)
+        else:
+            file_paths = (join(start_path, f) for f in listdir(start_path) if isfile(join(start_path, f)))
+
+        for file_path in file_paths:
+            if file_path.endswith(PARTIAL_FILE_SUFFIX):
+                continue
+            if search_archives and is_archive(file_path):
+                # Replace zip/tar file paths with virtual file paths of their members
+                for member_path in get_archive_member_paths(file_path):
+                    yield member_path
+            else:
+                yield file_path
+
 
-        return [join(start_path, f) for f in listdir(start_path) if isfile(join(start_path, f))]
-    return []
+def get_file_paths(start_path, search_subfolders=True, search_archives=True):
+    return list(iter_file_paths(start_path, search_subfolders=search_subfolders, search_archives=search_archives))
 
 
 def timestamp_to_string(time_stamp):
     return datetime.fromtimestamp(time_stamp).strftime('%Y-%m-%d %H:%M:%S')
 
 
+class DicomFileRecord:
+    """DICOM tags needed to link a file into plan file sets, __slots__ keeps a record per file small"""
+    __slots__ = ('modality', 'timestamp', 'study_instance_uid', 'sop_instance_uid', 'patient_name',
+                 'ref_type', 'ref_uid', 'ref_plan_uids', 'rt_plan_label', 'dose_summation_type')
+
+    def __init__(self, modality, timestamp, ds):
+        self.modality = modality
+        self.timestamp = timestamp
+        self.study_instance_uid = str(ds.StudyInstanceUID)
+        self.sop_instance_uid = str(ds.SOPInstanceUID)
+        self.patient_name = str(ds.PatientName)
+        self.rt_plan_label = None
+        self.dose_summation_type = None
+        self.ref_plan_uids = None
+
+        if modality == 'rtplan':
+            self.ref_type = 'struct'
+            self.ref_uid = str(ds.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID)
+            self.rt_plan_label = str(ds.RTPlanLabel)
+        elif modality == 'rtdose':
+            self.ref_type = 'plan'
+            self.ref_uid = str(ds.ReferencedRTPlanSequence[0].ReferencedSOPInstanceUID)
+            self.ref_plan_uids = tuple([str(ref.ReferencedSOPInstanceUID) for ref in ds.ReferencedRTPlanSequence])
+            self.dose_summation_type = str(getattr(ds, 'DoseSummationType', '')).upper()
+        else:
+            self.ref_type = None
+            self.ref_uid = None
+
+    @property
+    def is_multi_plan_dose(self):
+        """RTDOSE of a plan sum, e.g. primary + boost as exported by the planning system"""
+        return self.modality == 'rtdose' and (self.dose_summation_type == 'MULTI_PLAN' or len(self.ref_plan_uids) > 1)
+
+
 class DicomDirectoryParser:
-    def __init__(self, start_path, search_subfolders=True):
+    def __init__(self, start_path, search_subfolders=True, search_archives=True, parse=True):
+        """
+        :param parse: scan start_path now, else the scan is driven by iter_new_plans
+        """
         self.start_path = start_path
         self.search_subfolders = search_subfolders
+        self.search_archives = search_archives
         self.file_types = {'rtplan', 'rtstruct', 'rtdose'}
+        self.archive_reader = ArchiveReader()
 
-        self.__parse_directory_new()
-        self.__validate()
-
-    def __parse_directory_new(self):
-        self.file_paths = get_file_paths(self.start_path, search_subfolders=self.search_subfolders)
-
+        # dicom_tag_values: DicomFileRecord of each file, with file_paths for keys
+        # dicom_files:      identify files by modality (key is modality)
+        # plan_file_sets:   this will be the useful object in the end, give it "Patient Name - Plan Name", get
+        #                   appropriate file paths.  GUI will use this.
         self.dicom_tag_values = {}
         self.dicom_files = {key: [] for key in self.file_types}
         self.plan_file_sets = {}
 
-        # dicom_file_data:  collect necessary dicom tags with a dictionary with file_paths for keys
-        # dicom_files:      identify files by modality (key is modality)
-        # plan_file_sets:   this will be the useful object in the end, give it "Patient Name - Plan Name", get
-        #                   appropriate file paths.  GUI will use this.
-        for file_path in self.file_paths:
-            ds = self.read_dicom_file(file_path)
-            if ds is not None:
-                modality = ds.Modality.lower()
-                timestamp = getmtime(file_path)
-
-                self.dicom_files[modality].append(file_path)
-
-                self.dicom_tag_values[file_path] = {'timestamp': timestamp,
-                                                    'study_instance_uid': ds.StudyInstanceUID,
-                                                    'sop_instance_uid': ds.SOPInstanceUID,
-                                                    'patient_name': str(ds.PatientName)}
-
-                if modality == 'rtplan':
-                    self.dicom_tag_values[file_path]['ref_sop_instance'] = {'type': 'struct',
-                                                                            'uid': ds.ReferencedStructureSetSequence[0].ReferencedSOPInstanceUID}
-                    plan_key = "%s - %s - %s" % (ds.PatientName, ds.RTPlanLabel, timestamp_to_string(timestamp))
-                    self.plan_file_sets[plan_key] = {'rtplan': {'file_path': file_path, 'sop_instance_uid': ds.SOPInstanceUID}}
-                elif modality == 'rtdose':
-                    self.dicom_tag_values[file_path]['ref_sop_instance'] = {'type': 'plan',
-                                                                            'uid': ds.ReferencedRTPlanSequence[0].ReferencedSOPInstanceUID}
-                else:
-                    self.dicom_tag_values[file_path]['ref_sop_instance'] = {'type': None, 'uid': None}
-
-        # associate appropriate rtdose files to plans
-        for dose_file in self.dicom_files['rtdose']:
-            dose_tag_values = self.dicom_tag_values[dose_file]
-            ref_plan_uid = dose_tag_values['ref_sop_instance']['uid']
-            for plan_file_set in self.plan_file_sets.values():
-                plan_uid = plan_file_set['rtplan']['sop_instance_uid']
-                if plan_uid == ref_plan_uid:
-                    plan_file_set['rtdose'] = {'file_path': dose_file,
-                                               'sop_instance_uid': dose_tag_values['sop_instance_uid']}
-        # associate appropriate rtstruct files to plans
-        for plan_file_set in self.plan_file_sets.values():
-            plan_file = plan_file_set['rtplan']['file_path']
-            ref_struct_uid = self.dicom_tag_values[plan_file]['ref_sop_instance']['uid']
+        if parse:
+            self.__parse_directory_new()
+
+    def __parse_directory_new(self):
+        for _ in self.iter_new_plans():
+            pass
+
+    def iter_new_plans(self):
+        """
+        Scan start_path, yielding (plan_name, plan_files) as soon as a plan's RTPLAN, RTSTRUCT and RTDOSE have all
+        been seen. Plans dosed per beam are only yielded once the scan ends, as any file may hold another beam.
+        Plan sums are not yielded, use plans afterwards for the final file sets.
+        """
+        beam_dose_plans = []
+        try:
+            for file_path in iter_file_paths(self.start_path, search_subfolders=self.search_subfolders,
+                                             search_archives=self.search_archives):
+                ds = self.read_dicom_file(file_path)
+                if ds is not None:
+                    for plan_name in self.add_dataset(file_path, ds, self.get_mtime(file_path)):
+                        if self.has_beam_doses(plan_name):
+                            beam_dose_plans.append(plan_name)
+                        else:
+                            yield plan_name, self.get_plan_files(plan_name)
+        finally:
+            self.archive_reader.close()
+
+        for plan_name in beam_dose_plans:
+            yield plan_name, self.get_plan_files(plan_name)
+
+    def add_dataset(self, file_path, ds, timestamp):
+        """
+        Register a DICOM file and link it into plan_file_sets, regardless of the order files are seen in
+        :return: names of the plans completed by this file
+        """
+        modality = self.get_file_type(ds)
+        if modality == 'other':
+            return []
+
+        try:
+            record = DicomFileRecord(modality, timestamp, ds)
+        except (AttributeError, IndexError):
+            return []  # e.g. an RTDOSE without a referenced plan, which cannot be linked into a plan file set
+        self.dicom_files[modality].append(file_path)
+        self.dicom_tag_values[file_path] = record
+
+        if modality == 'rtplan':
+            plan_key = "%s - %s - %s" % (record.patient_name, record.rt_plan_label, timestamp_to_string(timestamp))
+            plan_file_set = {'rtplan': {'file_path': file_path, 'sop_instance_uid': record.sop_instance_uid}}
+            self.plan_file_sets[plan_key] = plan_file_set
+            for dose_file in self.dicom_files['rtdose']:
+                self.__link_dose(plan_file_set, dose_file)
             for struct_file in self.dicom_files['rtstruct']:
-                struct_uid = self.dicom_tag_values[struct_file]['sop_instance_uid']
-                if struct_uid == ref_struct_uid:
-                    plan_file_set['rtstruct'] = {'file_path': struct_file,
-                                                 'sop_instance_uid': struct_uid}
-
-    def __validate(self):
-        bad_plans = []
-        for key, plan_file_set in self.plan_file_sets.items():
-            if self.file_types != set(list(plan_file_set)):  # Does plan_file_set not have one of the file_types?
-                bad_plans.append(key)
-
-        for plan in bad_plans:
-            self.plan_file_sets.pop(plan)
-
-    @staticmethod
-    def read_dicom_file(file_path):
+                self.__link_struct(plan_file_set, struct_file)
+            return [plan_key] if self.is_plan_complete(plan_key) else []
+
+        completed = []
+        for plan_name, plan_file_set in self.plan_file_sets.items():
+            was_complete = self.is_plan_complete(plan_name)
+            if modality == 'rtdose':
+                self.__link_dose(plan_file_set, file_path)
+            else:
+                self.__link_struct(plan_file_set, file_path)
+            if not was_complete and self.is_plan_complete(plan_name):
+                completed.append(plan_name)
+        return completed
+
+    def __link_dose(self, plan_file_set, dose_file):
+        dose_record = self.dicom_tag_values[dose_file]
+        if dose_record.is_multi_plan_dose:
+            return  # not the dose of any one plan, see plan_sums
+        if plan_file_set['rtplan']['sop_instance_uid'] == dose_record.ref_uid:
+            if dose_record.dose_summation_type == 'BEAM':
+                # per-beam doses are collected to be summed, unless a dose for the whole plan is available
+                if 'rtdose' not in plan_file_set:
+                    plan_file_set['rtdose'] = {'file_path': [], 'sop_instance_uid': []}
+                if isinstance(plan_file_set['rtdose']['file_path'], list):
+                    plan_file_set['rtdose']['file_path'].append(dose_file)
+                    plan_file_set['rtdose']['sop_instance_uid'].append(dose_record.sop_instance_uid)
+            else:
+                plan_file_set['rtdose'] = {'file_path': dose_file,
+                                           'sop_instance_uid': dose_record.sop_instance_uid}
+
+    def __link_struct(self, plan_file_set, struct_file):
+        plan_file = plan_file_set['rtplan']['file_path']
+        ref_struct_uid = self.dicom_tag_values[plan_file].ref_uid
+        struct_uid = self.dicom_tag_values[struct_file].sop_instance_uid
+        if struct_uid == ref_struct_uid:
+            plan_file_set['rtstruct'] = {'file_path': struct_file,
+                                         'sop_instance_uid': struct_uid}
+
+    def is_plan_complete(self, plan_name):
+        # Does plan_file_set have each of the file_types?
+        return self.file_types == set(list(self.plan_file_sets[plan_name]))
+
+    def read_dicom_file(self, file_path):
+        import pydicom as dicom
+        from pydicom.errors import InvalidDicomError
         try:
+            if is_archive_member(file_path):
+                # stop_before_pixels means only the header is decompressed from the archive member
+                with self.archive_reader.open(file_path) as document:
+                    return dicom.read_file(document, stop_before_pixels=True)
             return dicom.read_file(file_path, stop_before_pixels=True)
         except InvalidDicomError:
             return None
 
+    def get_mtime(self, file_path):
+        if is_archive_member(file_path):
+            return self.archive_reader.get_mtime(file_path)
+        return getmtime(file_path)
+
     def get_file_type(self, dicom_file):
-        file_type = dicom_file.Modality.lower()
+        file_type = str(getattr(dicom_file, 'Modality', '')).lower()  # e.g. DICOMDIR has no Modality
         if file_type not in self.file_types:
             return 'other'
         return file_type
 
     @property
     def plan_names(self):
-        return list(self.plan_file_sets)
+        return [plan_name for plan_name in list(self.plan_file_sets) if self.is_plan_complete(plan_name)]
+
+    def has_beam_doses(self, plan_name):
+        return isinstance(self.plan_file_sets[plan_name]['rtdose']['file_path'], list)
 
     def get_plan_files(self, plan_name):
-        return {file_type: self.plan_file_sets[plan_name][file_type]['file_path'] for file_type in self.file_types}
+        plan_file_set = self.plan_file_sets[plan_name]
+        plan_files = {file_type: plan_file_set[file_type]['file_path'] for file_type in self.file_types}
+        if self.has_beam_doses(plan_name):
+            plan_files['rtdose'] = list(plan_files['rtdose'])  # do not share the list still being added to
+        return plan_files
+
+    @property
+    def plan_sums(self):
+        """
+        Plans are only summed when a MULTI_PLAN RTDOSE references them, plans merely sharing a structure set may
+        be replans or alternatives rather than parts of one course. Other plans are summed when selected by the
+        user, see get_plan_sum_files.
+        :return: plan files by plan sum name, rtplan is a list of files, rtdose is the MULTI_PLAN dose
+        """
+        plans_by_uid = {}
+        for plan_name in self.plan_names:
+            plans_by_uid[self.plan_file_sets[plan_name]['rtplan']['sop_instance_uid']] = plan_name
+
+        plan_sums = {}
+        for dose_file in self.dicom_files['rtdose']:
+            dose_record = self.dicom_tag_values[dose_file]
+            if not dose_record.is_multi_plan_dose or not set(dose_record.ref_plan_uids).issubset(plans_by_uid):
+                continue
+            plan_files = [self.get_plan_files(plans_by_uid[uid]) for uid in sorted(set(dose_record.ref_plan_uids))]
+            plan_tags = [self.dicom_tag_values[files['rtplan']] for files in plan_files]
+            plan_sum_name = "%s - Plan Sum - %s - %s" % (plan_tags[0].patient_name,
+                                                         ' + '.join([tags.rt_plan_label for tags in plan_tags]),
+                                                         timestamp_to_string(dose_record.timestamp))
+            plan_sums[plan_sum_name] = {'rtplan': [files['rtplan'] for files in plan_files],
+                                        'rtstruct': plan_files[0]['rtstruct'],
+                                        'rtdose': dose_file}
+        return plan_sums
 
     @property
     def plans(self):
-        return {plan_name: self.get_plan_files(plan_name) for plan_name in self.plan_names}
+        plans = {plan_name: self.get_plan_files(plan_name) for plan_name in self.plan_names}
+        plans.update(self.plan_sums)
+        return plans
+
+
+def get_plan_sum_files(plans):
+    """
+    :param plans: plan files of complete plans sharing a structure set, e.g. a primary and its boost
+    :return: plan files of their sum, the doses of every plan (or their beam doses) are listed to be summed
+    """
+    dose_files = []
+    for plan_files in plans:
+        dose_files.extend(plan_files['rtdose'] if isinstance(plan_files['rtdose'], list) else [plan_files['rtdose']])
+    return {'rtplan': [plan_files['rtplan'] for plan_files in plans],
+            'rtstruct': plans[0]['rtstruct'],
+            'rtdose': dose_files}
 
 
 def get_plans(start_path):
@@ -1,20 +1,25 @@
 from __future__ import print_function
+from functools import partial
+from html import escape
+from bokeh.io import curdoc
 from bokeh.layouts import column, row
-from bokeh.models.widgets import Select, Button, DataTable, TableColumn, NumberFormatter, Div, HTMLTemplateFormatter
+from bokeh.models.widgets import Select, MultiChoice, Button, DataTable, TableColumn, NumberFormatter, Div, \
+    HTMLTemplateFormatter
 from bokeh.models import ColumnDataSource, HoverTool
 from bokeh.plotting import figure
-from dicompylercore import dicomparser, dvhcalc
-from protocols import Protocols, MAX_DOSE_VOLUME
-from utilities import get_plans
+from protocols import MAX_DOSE_VOLUME
+from utilities import DicomDirectoryParser, get_plan_sum_files
+from scoring import get_structures, get_roi_key_map, get_dvh, calculate_constraint, get_pass_fail
 from paths import INBOX_DIR
-from structure_aliases import StructureAliases
+from app_context import get_app_context
+from history import get_plan_info
 from bokeh.palettes import Colorblind8 as palette
 import itertools
-import numpy as np
 
 
 class ScoreCardView:
-    def __init__(self):
+    def __init__(self, doc=None):
+        self.doc = doc if doc is not None else curdoc()
 
         # Initialize Data Objects
         self.dvh = None
@@ -25,14 +30,18 @@ class ScoreCardView:
         self.roi_names = None
         self.roi_key_map = None
         self.plans = None
+        self.plan_scan = None
         self.structures = None
         self.protocol_data = None
         self.roi_override = {}
-        self.aliases = StructureAliases()
-        self.protocols = Protocols()
+        self.app_context = get_app_context()
+        self.aliases = self.app_context.aliases
+        self.protocols = self.app_context.protocols
+        self.history = self.app_context.history
+        self.plan_info = None
         self.source_data = ColumnDataSource(data=dict(roi_name=[], roi_template=[], roi_key=[], volume=[], min_dose=[],
-                                                      mean_dose=[], max_dose=[], constraint=[], constraint_calc=[],
-                                                      pass_fail=[], calc_type=[]))
+                                                      mean_dose=[], max_dose=[], constraint=[], constraint_label=[],
+                                                      threshold=[], constraint_calc=[], pass_fail=[], calc_type=[]))
         self.source_plot = ColumnDataSource(data=dict(x=[], y=[], color=[]))
         self.colors = itertools.cycle(palette)
 
@@ -46,6 +55,7 @@ class ScoreCardView:
     def __define_layout_objects(self):
         # Report heading data
         self.select_plan = Select(title='Plan:')
+        self.select_plan_sum = MultiChoice(title='Sum with plans:', options=[], value=[])
         self.button_refresh_plans = Button(label='Scan DICOM Inbox', button_type='primary')
         self.select_protocol = Select(title='Protocol:', options=self.protocols.protocol_names, value='TG101')
         self.select_fx = Select(title='Fractions:', value='3', options=self.fractionation_options)
@@ -54,6 +64,7 @@ class ScoreCardView:
         self.select_roi_template = Select(title='Template ROI:')
         self.select_roi = Select(title='Plan ROI:')
         self.max_dose_volume = Div(text="<b>Point defined as %scc" % MAX_DOSE_VOLUME)
+        self.calculation_error = Div(text='', style={'color': 'red'})
 
         self.columns = [TableColumn(field="roi_template", title="Template ROI"),
                         TableColumn(field="roi_name", title="ROI"),
@@ -91,6 +102,7 @@ class ScoreCardView:
         self.select_fx.on_change('value', self.fx_listener)
         self.button_refresh_plans.on_click(self.update_plan_options)
         self.select_plan.on_change('value', self.plan_listener)
+        self.select_plan_sum.on_change('value', self.plan_sum_listener)
         self.select_roi_template.on_change('value', self.template_roi_listener)
         self.select_roi.on_change('value', self.roi_listener)
         self.source_data.selected.on_change('indices', self.source_select)
@@ -98,9 +110,11 @@ class ScoreCardView:
     def __do_layout(self):
 
         self.layout = column(row(self.select_plan, self.select_protocol, self.select_fx),
+                             self.select_plan_sum,
                              row(self.button_refresh_plans, self.button_calculate, self.button_delete_roi),
                              row(self.select_roi_template, self.select_roi),
                              self.max_dose_volume,
+                             self.calculation_error,
                              self.data_table,
                              self.plot)
 
@@ -150,6 +164,23 @@ class ScoreCardView:
     def current_struct_file(self):
         return self.plans[self.select_plan.value]['rtstruct']
 
+    @property
+    def current_plan_files(self):
+        plan_files = self.plans[self.select_plan.value]
+        summed_plans = [self.plans[plan_name] for plan_name in self.select_plan_sum.value if plan_name in self.plans]
+        if summed_plans:
+            return get_plan_sum_files([plan_files] + summed_plans)
+        return plan_files
+
+    @property
+    def plan_sum_options(self):
+        """Other single plans on the structure set of the selected plan, e.g. a boost of the primary plan"""
+        if not self.plans or self.select_plan.value not in self.plans:
+            return []
+        return [plan_name for plan_name, plan_files in self.plans.items()
+                if plan_name != self.select_plan.value and not isinstance(plan_files['rtplan'], list) and
+                plan_files['rtstruct'] == self.current_struct_file]
+
     # Listeners -------------------------------------------------------------------
     def protocol_listener(self, attr, old, new):
         self.select_fx.options = self.fractionation_options
@@ -165,7 +196,16 @@ class ScoreCardView:
 
     def plan_listener(self, attr, old, new):
         self.roi_override = {}
-        if new in list(self.plans):
+        self.plan_info = None
+        self.select_plan_sum.options = self.plan_sum_options
+        if self.select_plan_sum.value:
+            self.select_plan_sum.value = []  # Changing select_plan_sum.value will prompt initialize_source_data
+        elif new in list(self.plans):
+            self.initialize_source_data()
+
+    def plan_sum_listener(self, attr, old, new):
+        self.plan_info = None
+        if self.plans and self.select_plan.value in self.plans:
             self.initialize_source_data()
 
     def template_roi_listener(self, attr, old, new):
@@ -174,6 +214,10 @@ class ScoreCardView:
     def roi_listener(self, attr, old, new):
         template_rois = self.source_data.data['roi_template']
         indices = [i for i, roi in enumerate(template_rois) if roi == self.select_roi_template.value]
+        # while calculating, this is match_rois selecting a matched ROI and calculate_dvhs saves the results,
+        # otherwise it may also be a table row selected by the user (source_select), which changes no ROI
+        is_idle = self.button_calculate.button_type == 'primary'
+        is_override = is_idle and any(self.source_data.data['roi_name'][i] != new for i in indices)
         if indices:
             patches = {'roi_name': [(i, new) for i in indices]}
             self.source_data.patch(patches)
@@ -181,14 +225,20 @@ class ScoreCardView:
             self.roi_override[self.select_roi_template.value] = new
             self.button_calculate.label = 'Calculating...'
             self.button_calculate.button_type = 'success'
-            for i in indices:
-                key = self.roi_key_map[new]
-                self.calculate_dvh(key)
-                self.update_table_row(i, key)
-                self.source_data.patch({'roi_key': [(i, key)]})
-                self.update_constraint(i)
-            self.button_calculate.label = 'Calculate'
-            self.button_calculate.button_type = 'primary'
+            try:
+                for i in indices:
+                    key = self.roi_key_map[new]
+                    self.calculate_dvh(key)
+                    self.update_table_row(i, key)
+                    self.source_data.patch({'roi_key': [(i, key)]})
+                    self.update_constraint(i)
+            except ValueError as e:
+                self.show_calculation_error(e)
+            if is_override:
+                self.save_history()
+            if is_idle:
+                self.button_calculate.label = 'Calculate'
+                self.button_calculate.button_type = 'primary'
         else:
             if self.button_calculate.button_type == 'primary' and self.select_roi_template.value in self.roi_override:
                 self.roi_override.pop(self.select_roi_template.value)
@@ -226,13 +276,15 @@ class ScoreCardView:
                     'mean_dose': [''] * row_count,
                     'max_dose': [''] * row_count,
                     'constraint': data['string_rep'],
+                    'constraint_label': data['constraint_label'],
+                    'threshold': data['threshold'],
                     'constraint_calc': [''] * row_count,
                     'pass_fail': [''] * row_count,
                     'calc_type': data['calc_type']}
 
         self.source_data.data = new_data
         self.update_roi_template_select()
-        if self.select_plan.value:
+        if self.plans and self.select_plan.value in self.plans:
             self.button_calculate.label = 'Calculating...'
             self.button_calculate.button_type = 'success'
             self.update_plan_structures()
@@ -260,26 +312,61 @@ class ScoreCardView:
     def update_plan_options(self):
         self.button_refresh_plans.button_type = 'success'
         self.button_refresh_plans.label = 'Updating...'
-        self.plans = get_plans(INBOX_DIR)
+        receiver = self.app_context.dicom_receiver
+        # received objects are already indexed, the scan only adds files copied into the inbox
+        self.plans = receiver.plans if receiver is not None else {}
+        if self.select_plan.value not in self.plans:
+            self.select_plan.value = ''  # the selected plan may not be found again
+        self.select_plan.options = list(self.plans)
+
+        # plans are added to select_plan one tick at a time, so they are shown while the scan continues
+        parser = DicomDirectoryParser(receiver.inbox_dir if receiver is not None else INBOX_DIR, parse=False)
+        self.plan_scan = parser.iter_new_plans()
+        self.doc.add_next_tick_callback(partial(self.scan_next_plan, parser, self.plan_scan))
+
+    def scan_next_plan(self, parser, plan_scan):
+        if plan_scan is not self.plan_scan:  # a newer scan has been started
+            return
+        plan = next(plan_scan, None)
+        if plan is None:
+            receiver = self.app_context.dicom_receiver
+            if receiver is not None:
+                receiver.rescan(parser)
+                self.plans = receiver.plans
+            else:
+                self.plans = parser.plans
+            self.finish_plan_options()
+        else:
+            plan_name, plan_files = plan
+            if plan_name not in self.plans:
+                self.select_plan.options = self.select_plan.options + [plan_name]
+            self.plans[plan_name] = plan_files
+            self.doc.add_next_tick_callback(partial(self.scan_next_plan, parser, plan_scan))
+
+    def finish_plan_options(self):
+        self.plan_scan = None
         self.select_plan.options = list(self.plans)
         self.button_refresh_plans.button_type = 'primary'
         self.button_refresh_plans.label = 'Scan DICOM Inbox'
-        if self.select_plan.value not in list(self.plans):
+        if self.plans and self.select_plan.value not in list(self.plans):
             self.select_plan.value = list(self.plans)[0]
+        else:
+            self.select_plan_sum.options = self.plan_sum_options  # the scan may have found more plans to sum
 
     def update_plan_structures(self):
-        self.structures = dicomparser.DicomParser(self.current_struct_file).GetStructures()
+        self.structures = get_structures(self.current_struct_file)
+        self.roi_key_map = get_roi_key_map(self.structures)
         self.roi_keys = [key for key in self.structures if self.structures[key]['type'].upper() != 'MARKER']
         self.roi_names = [str(self.structures[key]['name']) for key in self.roi_keys]
-        self.roi_key_map = {name: self.roi_keys[i] for i, name in enumerate(self.roi_names)}
         self.select_roi.options = [''] + self.roi_names
-        self.update_roi_select()
+        self.match_rois()
 
     def update_roi_select(self):
         index = self.source_data.data['roi_template'].index(self.select_roi_template.value)
         self.select_roi.value = self.source_data.data['roi_name'][index]
 
     def match_rois(self):
+        self.dvh = {}  # update_roi_select below may already calculate the DVH of the selected ROI
         matches = self.aliases.match_protocol_rois(self.source_data.data['roi_template'], self.roi_names)
         patches = {'roi_name': [], 'roi_key': []}
         for i, protocol_roi in enumerate(self.source_data.data['roi_template']):
@@ -308,20 +395,27 @@ class ScoreCardView:
 
     def calculate_dvh(self, key):
         if key not in list(self.dvh):
-            files = self.plans[self.select_plan.value]
-            self.dvh[key] = dvhcalc.get_dvh(files['rtstruct'], files['rtdose'], key)
+            files = self.current_plan_files
+            self.dvh[key] = get_dvh(files['rtstruct'], files['rtdose'], key)
 
     def calculate_dvhs(self):
-        self.dvh = {}
-        for i, key in enumerate(self.source_data.data['roi_key']):
-            if key:
-                self.calculate_dvh(key)
-                self.update_table_row(i, key)
-                self.update_constraint(i)
+        self.calculation_error.text = ''
+        try:
+            for i, key in enumerate(self.source_data.data['roi_key']):
+                if key:
+                    self.calculate_dvh(key)
+                    self.update_table_row(i, key)
+                    self.update_constraint(i)
+        except ValueError as e:  # e.g. doses that cannot be summed
+            self.show_calculation_error(e)
+        self.save_history()
 
         self.button_calculate.label = 'Calculate'
         self.button_calculate.button_type = 'primary'
 
+    def show_calculation_error(self, error):
+        self.calculation_error.text = "<b>DVH calculation failed:</b> %s" % escape(str(error))
+
     def update_constraint(self, index):
 
         if self.source_data.data['roi_name'][index]:
@@ -329,15 +423,7 @@ class ScoreCardView:
 
             operator = self.protocol_data['operator'][index]
             threshold = self.protocol_data['threshold_value'][index]
-
-            if constraint is not None:
-                if operator == '<':
-                    status = constraint < threshold
-                else:
-                    status = constraint > threshold
-                status = ['Fail', 'Pass'][status]
-            else:
-                status = ''
+            status = get_pass_fail(constraint, operator, threshold)
 
             self.source_data.patch({'constraint_calc': [(index, constraint)],
                                     'pass_fail': [(index, status)]})
@@ -346,20 +432,12 @@ class ScoreCardView:
         dvh = self.dvh[self.source_data.data['roi_key'][index]]
         calc_type = self.source_data.data['calc_type'][index]
         input_value = self.protocol_data['input_value'][index]
-        if calc_type == 'Volume':
-            ans = dvh.dose_constraint(input_value, volume_units='cm3')
-            return float(str(ans).split(' ')[0])
-        if calc_type == 'Dose':
-            ans = dvh.volume_constraint(input_value, dose_units='Gy')
-            return float(str(ans).split(' ')[0])
-        if calc_type == 'Mean':
-            return self.source_data.data['mean_dose'][index]
-        if calc_type == 'MVS':
-            ans = dvh.volume_constraint(input_value, dose_units='Gy')
-            ans = float(str(ans).split(' ')[0])
-            return self.source_data.data['volume'][index] - ans
-
-        return None
+        return calculate_constraint(dvh, calc_type, input_value)
+
+    def save_history(self):
+        if self.plan_info is None:
+            self.plan_info = get_plan_info(self.current_plan_files)
+        self.history.add_score_card(self.source_data.data, self.plan_info, self.protocol, self.fractionation)
 
     # def pad_dvh_counts(self):
     #     print(len(self.dvh_counts))
@@ -373,7 +451,7 @@ class ScoreCardView:
     #     self.dvh_counts = np.array(padded_dvhs)
 
     def update_dvh(self, key):
-        if key:
+        if key and key in self.dvh:
             y_axis = self.dvh[key].counts
             self.source_plot.data = {'x': list(range(len(y_axis))), 'y': y_axis}
         else:
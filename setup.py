@@ -22,6 +22,7 @@ setup(
     keywords=['dvh', 'radiation therapy', 'dicom', 'dicom-rt', 'bokeh'],
     classifiers=[],
     install_requires=requires,
+    extras_require={'scp': ['pynetdicom']},
     entry_points={
         'console_scripts': [
             'dvh-check=dvh-check.__main__:main',